@@ -28,6 +28,12 @@ void loop() {
         // read all the available characters into a string
         serialInput= Serial.readString();
 
+        // acknowledge readiness requests instead of displaying them
+        if (serialInput == "?") {
+            Serial.print('K');
+            return;
+        }
+
         // split the input string into 16-char substrings and save into displayLines
         if (serialInput.length() <= 16) {
             displayLines[0] = serialInput;
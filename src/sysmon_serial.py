@@ -3,21 +3,56 @@
 # Displays system resource usage information on an Arduino 16x2 LCD
 # DEPENDECNIES (python): pyserial psutil
 
-import datetime, os, psutil, serial, time
-from typing import Tuple
+import fcntl, glob, os, psutil, serial, termios, time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
 
 # file to send serial data to
 file_descriptor = '/dev/ttyACM0'
 baud_rate = 9600
 
-# time to wait until serial port is open after initializing the connection
+# maximum time to wait until serial port is open after initializing the connection
 serial_init_interval_seconds = 6
+# time to wait for the Arduino to acknowledge a single readiness request
+serial_handshake_timeout_seconds = 1.5
 # time between updates to the serial port
 serial_update_interval_seconds = 3
 
+# 32-byte frames of the screens (two rows of 16 characters), pre-filled with their constant
+# characters. On each update, only the digits are written into their fixed positions.
+_LOAD_AVG_FRAME = bytearray(b'    Load AVG    ' b'  .     .     . ')
+_CPU_USAGE_FRAME = bytearray(b'   CPU  Usage   ' b'    . MHz    . %')
+_MEM_USAGE_FRAME = bytearray(b'   MEM  Usage   ' b'  .   GiB    . %')
+_TEMPERATURE_FRAME = bytearray(b'CPU  Temp    . C' b'MoBo Temp    . C')
+_UPTIME_FRAME = bytearray(b'     Uptime     ' b'     d    h    m')
 
-def format_float_as_string(number: float, integer_digits: int, decimal_digits: int) -> str:
-    """ Converts a float into its string representation according to the arguments.
+# views through which the digits are written into the frames. Unlike slice assignment on a
+# bytearray, which resizes it, a field of the wrong width raises ValueError.
+_LOAD_AVG_VIEW = memoryview(_LOAD_AVG_FRAME)
+_CPU_USAGE_VIEW = memoryview(_CPU_USAGE_FRAME)
+_MEM_USAGE_VIEW = memoryview(_MEM_USAGE_FRAME)
+_TEMPERATURE_VIEW = memoryview(_TEMPERATURE_FRAME)
+_UPTIME_VIEW = memoryview(_UPTIME_FRAME)
+
+# number of bytes in a GiB
+_BYTES_PER_GIB = pow(2, 30)
+
+# system boot time on the monotonic clock. psutil.boot_time() is derived from the wall clock
+# and moves whenever it is stepped (e.g. by NTP after boot), so it is converted once here
+_BOOT_MONOTONIC = time.monotonic() - (time.time() - psutil.boot_time())
+
+# per-CPU frequency files (in kHz) on Linux, discovered once instead of on every update
+_CPU_FREQ_PATHS = sorted(glob.glob('/sys/devices/system/cpu/cpu[0-9]*/cpufreq/scaling_cur_freq'))
+
+# encoded uptime fields of the previous update, only rebuilt once their value changes
+_uptime_cache = {'days': None, 'days_bytes': b'', 'hours': None, 'hours_bytes': b''}
+
+
+def make_float_formatter(integer_digits: int, decimal_digits: int) -> Callable[[float], str]:
+    """ Creates a function which converts a float into its string representation according to the arguments.
+
+        The bounds and the format string only depend on the arguments, so they are computed once
+        here instead of on every conversion.
 
         The integer part of the resulting string will contain exactly 'integer_digits' number of
         characters. Excess space is padded with blank spaces. If 'number' is larger than the largest
@@ -32,15 +67,12 @@ def format_float_as_string(number: float, integer_digits: int, decimal_digits: i
 
         Examples
         --------
-        format_float_as_string(123.45, 4, 3) -> ' 123.450'
-        format_float_as_string(123.45, 2, 1) ->   '99.4'
-        format_float_as_string(-23.45, 2, 3) ->   '-9.450'
+        make_float_formatter(4, 3)(123.45) -> ' 123.450'
+        make_float_formatter(2, 1)(123.45) ->   '99.9'
+        make_float_formatter(2, 3)(-23.45) ->   '-9.999'
 
         Arguments
         ---------
-        number : float
-            The number to be formatted and converted into a string.
-
         integer_digits : int
             The number of digits which the integer part of the string representation will have.
 
@@ -49,216 +81,294 @@ def format_float_as_string(number: float, integer_digits: int, decimal_digits: i
 
         Returns
         -------
-        float_as_string : str
-            A string representation of number, where the number of characters before the decimal point is exactly
-            'integer_digits' and where the number of characters after the decimal point is exactly 'decimal_digits'.
+        format_float_as_string : Callable[[float], str]
+            A function taking a float and returning its string representation, where the number of characters
+            before the decimal point is exactly 'integer_digits' and where the number of characters after the
+            decimal point is exactly 'decimal_digits'.
     """
-    # calculate smallest/largest possible integer for the given number of integer digits,
+    # calculate smallest/largest possible number for the given number of digits,
     # taking into account the '-' sign on negative numbers
-    max_integer_size = pow(10, integer_digits) - 1
-    min_integer_size = 0 - int(max_integer_size / 10)
+    resolution = pow(10, -decimal_digits)
+    max_number = pow(10, integer_digits) - resolution
+    min_number = resolution - pow(10, integer_digits - 1) if integer_digits > 1 else 0.0
+
+    # the builtin formatter pads the integer part with spaces and the decimal part with zeroes
+    format_string = '%{0}.{1}f'.format(integer_digits + 1 + decimal_digits, decimal_digits)
 
-    # split input number into integer part and decimal part
-    integer_part = int(number)
-    decimal_part = abs(number) - abs(integer_part)
+    def format_float_as_string(number: float) -> str:
+        # max out the number if the number of integer digits is exceeded
+        if number < min_number:
+            number = min_number
+        elif number > max_number:
+            number = max_number
 
-    # max out integer part if number of digits is exceeded
-    if number < min_integer_size:
-        integer_part = min_integer_size
-    if number > max_integer_size:
-        integer_part = max_integer_size
+        return format_string % number
 
-    # round decimal part to 'decimal_digits' decimal places
-    decimal_part = round(decimal_part, decimal_digits)
-    # cast to integer
-    decimal_part = int(decimal_part * pow(10, decimal_digits))
+    return format_float_as_string
 
-    # cast to string
-    integer_part=str(integer_part)
-    decimal_part=str(decimal_part)
+# formatters for each of the number layouts used on the display
+_format_2_1 = make_float_formatter(2, 1)
+_format_2_2 = make_float_formatter(2, 2)
+_format_2_3 = make_float_formatter(2, 3)
+_format_3_1 = make_float_formatter(3, 1)
+_format_4_1 = make_float_formatter(4, 1)
 
-    # pad integer_part with spaces on the left if necessary
-    integer_part = integer_part.rjust(integer_digits, ' ')
-    # pad decimal_part with zeroes on the right if necessary
-    #decimal_part = decimal_part.rjust(decimal_digits, '0')
+def read_cpu_frequency() -> float:
+    """ Retrieve the current CPU frequency in MHz, averaged over all CPUs.
 
-    return integer_part + '.' + decimal_part
+    Reads the cpufreq files found at startup directly, skipping those which can't be read,
+    e.g. because their CPU went offline. Falls back to psutil on systems which don't provide
+    them or if none of them can be read.
 
-def get_load_avg() -> Tuple[str]:
+    Returns
+    -------
+    cpu_freq : float
+        The current average CPU frequency in MHz.
+    """
+    total_khz = 0
+    readable_paths = 0
+    for path in _CPU_FREQ_PATHS:
+        try:
+            with open(path) as freq_file:
+                total_khz += int(freq_file.read())
+        except (OSError, ValueError):
+            continue
+        readable_paths += 1
+
+    if not readable_paths:
+        return psutil.cpu_freq()[0]
+
+    return total_khz / readable_paths / 1000
+
+def get_load_avg() -> bytearray:
     """ Retrieve average load values of the system.
 
-    Returns a tuple containing two strings, each of 16 characters in length.
-    The first and second string contained are in the following format respectively:
+    Returns a frame of 32 ASCII characters, the first and last 16 of which are in the following
+    format respectively:
     '    Load AVG    '
     'XX.XX XX.XX XX.X'
+
+    The returned frame is reused and overwritten on the next call.
     
     Returns
     -------
-    output : Tuple(str)
-        A tuple containing two strings, each of 16 characters in length.
-        They contain system information about CPU load averages.
+    frame : bytearray
+        A frame of 32 ASCII characters, making up both rows of the display.
+        It contains system information about CPU load averages.
     """
     # psutil.getloadavg() produces three floats inside a tuple
     load_all = psutil.getloadavg()
 
-    output = (
-        # first row
-        '    Load AVG    ',
-
-        # second row, with each number in the format 'XX.XX'
-        # except the last number in the format 'XX.X'
-        '{0} {1} {2}'.format(
-            format_float_as_string(load_all[0], 2, 2),
-            format_float_as_string(load_all[1], 2, 2),
-            format_float_as_string(load_all[2], 2, 1)
-            )
-    )
+    # each number in the format 'XX.XX' except the last number in the format 'XX.X'
+    frame = _LOAD_AVG_FRAME
+    view = _LOAD_AVG_VIEW
+    view[16:21] = _format_2_2(load_all[0]).encode('ascii')
+    view[22:27] = _format_2_2(load_all[1]).encode('ascii')
+    view[28:32] = _format_2_1(load_all[2]).encode('ascii')
 
-    return output
+    return frame
 
-def get_cpu_usage():
+def get_cpu_usage() -> bytearray:
     """ Retrieve current CPU frequency and utilization (in percent) of the system.
 
-    Returns a tuple containing two strings, each of 16 characters in length.
-    The first and second string contained are in the following format respectively:
+    Returns a frame of 32 ASCII characters, the first and last 16 of which are in the following
+    format respectively:
     '   CPU  Usage   '
     'XXXX.XMHz XXX.X%'
+
+    The returned frame is reused and overwritten on the next call.
     
     Returns
     -------
-    output : Tuple(str)
-        A tuple containing two strings, each of 16 characters in length.
-        They contain system information about current CPU frequency and utilization.
+    frame : bytearray
+        A frame of 32 ASCII characters, making up both rows of the display.
+        It contains system information about current CPU frequency and utilization.
     """
     # each call returns a float
-    cpu_freq = psutil.cpu_freq()[0]
+    cpu_freq = read_cpu_frequency()
     cpu_percent = psutil.cpu_percent(interval=None)
 
-    output = (
-        '   CPU  Usage   ',
-        '{0}MHz {1}%'.format(
-            format_float_as_string(cpu_freq, 4, 1),
-            format_float_as_string(cpu_percent, 3, 1)
-        )
-    )
+    frame = _CPU_USAGE_FRAME
+    view = _CPU_USAGE_VIEW
+    view[16:22] = _format_4_1(cpu_freq).encode('ascii')
+    view[26:31] = _format_3_1(cpu_percent).encode('ascii')
 
-    return output
+    return frame
 
-def get_memory_usage():
+def get_memory_usage() -> bytearray:
     """ Retrieve current memory usage of the system.
 
-    Returns a tuple containing two strings, each of 16 characters in length.
-    The first and second string contained are in the following format respectively:
+    Returns a frame of 32 ASCII characters, the first and last 16 of which are in the following
+    format respectively:
     '   MEM  Usage   '
     'XX.XXXGiB XXX.X%'
+
+    The returned frame is reused and overwritten on the next call.
     
     Returns
     -------
-    output : Tuple(str)
-        A tuple containing two strings, each of 16 characters in length.
-        They contain system information about current memory usage.
+    frame : bytearray
+        A frame of 32 ASCII characters, making up both rows of the display.
+        It contains system information about current memory usage.
     """
-    # each call returns a float
-    mem_used_bytes = psutil.virtual_memory().used
-    mem_percent = psutil.virtual_memory().percent
+    # a single snapshot provides both the used bytes and the percentage
+    virtual_memory = psutil.virtual_memory()
+    mem_used_bytes = virtual_memory.used
+    mem_percent = virtual_memory.percent
 
     # convert mem_used_bytes to GiB
-    mem_used_gib = mem_used_bytes / pow(2, 30)
+    mem_used_gib = mem_used_bytes / _BYTES_PER_GIB
 
-    output = (
-        '   MEM  Usage   ',
-        '{0}GiB {1}%'.format(
-            format_float_as_string(mem_used_gib, 2, 3),
-            format_float_as_string(mem_percent, 3, 1)
-        )
-    )
+    frame = _MEM_USAGE_FRAME
+    view = _MEM_USAGE_VIEW
+    view[16:22] = _format_2_3(mem_used_gib).encode('ascii')
+    view[26:31] = _format_3_1(mem_percent).encode('ascii')
 
-    return output
+    return frame
 
-def get_cpu_mobo_temperature():
+def get_cpu_mobo_temperature() -> bytearray:
     """ Retrieve current CPU and mainboard temperature readings of the system.
 
-    Returns a tuple containing two strings, each of 16 characters in length.
-    The first and second string contained are in the following format respectively:
+    Returns a frame of 32 ASCII characters, the first and last 16 of which are in the following
+    format respectively:
     'CPU  Temp XXX.XC'
     'MoBo Temp XXX.XC'
+
+    The returned frame is reused and overwritten on the next call.
     
     Returns
     -------
-    output : Tuple(str)
-        A tuple containing two strings, each of 16 characters in length.
-        They contain information about current CPU/chipset temperature readings.
+    frame : bytearray
+        A frame of 32 ASCII characters, making up both rows of the display.
+        It contains information about current CPU/chipset temperature readings.
     """
+    frame = _TEMPERATURE_FRAME
+    view = _TEMPERATURE_VIEW
+
     # XXX the following function calls are system-specific!
     # Use 'sensor_info.py' to determine the correct sensors for your system.
     # More info: 'https://psutil.readthedocs.io/en/latest/#psutil.sensors_temperatures'
+    temperatures = psutil.sensors_temperatures()
     try:
         # works on AMD processors
-        cpu_temp = psutil.sensors_temperatures().get('k10temp')[0].current
+        cpu_temp = temperatures.get('k10temp')[0].current
         # works on thinkpad mainboards
-        mobo_temp = psutil.sensors_temperatures().get('thinkpad')[0].current
+        mobo_temp = temperatures.get('thinkpad')[0].current
 
-        output = (
-            'CPU  Temp {}C'.format(format_float_as_string(cpu_temp, 3, 1)),
-            'MoBo Temp {}C'.format(format_float_as_string(mobo_temp, 3, 1))
-        )
+        view[10:15] = _format_3_1(cpu_temp).encode('ascii')
+        view[26:31] = _format_3_1(mobo_temp).encode('ascii')
     except TypeError:
         print("get_cpu_mobo_temperature(): Failed sensor lookup! Please enter correct sensor information.")
-        output = (
-            'CPU  Temp {}C'.format(" NaN "),
-            'MoBo Temp {}C'.format(" NaN ")
-        )
+        view[10:15] = b' NaN '
+        view[26:31] = b' NaN '
 
-    return output
+    return frame
 
-def get_uptime():
+def get_uptime() -> bytearray:
     """ Retrieve current system uptime information.
 
-    Returns a tuple containing two strings, each of 16 characters in length.
-    The first and second string contained are in the following format respectively:
+    Returns a frame of 32 ASCII characters, the first and last 16 of which are in the following
+    format respectively:
     '     Uptime     '
     'XXXX d XX h XX m'
+
+    The returned frame is reused and overwritten on the next call.
     
     Returns
     -------
-    output : Tuple(str)
-        A tuple containing two strings, each of 16 characters in length.
-        They contain system information about the current uptime.
+    frame : bytearray
+        A frame of 32 ASCII characters, making up both rows of the display.
+        It contains system information about the current uptime.
+    """
+    seconds_since_boot = int(time.monotonic() - _BOOT_MONOTONIC)
+
+    # calculate the values as integers
+    days_since_boot, seconds_since_boot = divmod(seconds_since_boot, 86400)
+    hours_since_boot, seconds_since_boot = divmod(seconds_since_boot, 3600)
+    minutes_since_boot = seconds_since_boot // 60
+
+    # limit the days so that they fit into their four characters
+    days_since_boot = max(0, min(days_since_boot, 9999))
+
+    # cast to padded strings, days and hours change rarely and are reused from the cache
+    if days_since_boot != _uptime_cache['days']:
+        _uptime_cache['days'] = days_since_boot
+        _uptime_cache['days_bytes'] = ('%4d' % days_since_boot).encode('ascii')
+    if hours_since_boot != _uptime_cache['hours']:
+        _uptime_cache['hours'] = hours_since_boot
+        _uptime_cache['hours_bytes'] = ('%2d' % hours_since_boot).encode('ascii')
+
+    frame = _UPTIME_FRAME
+    view = _UPTIME_VIEW
+    view[16:20] = _uptime_cache['days_bytes']
+    view[23:25] = _uptime_cache['hours_bytes']
+    view[28:30] = ('%2d' % minutes_since_boot).encode('ascii')
+
+    return frame
+
+def send_frame(serial_fd: int, frame: bytes):
+    """ Writes a frame to the serial port and blocks until it is transmitted.
+
+    Writes to the file descriptor directly, bypassing the overhead of pyserial's write().
+    The file descriptor must be in blocking mode.
+
+    Arguments
+    ---------
+    serial_fd : int
+        The file descriptor of the open serial connection to the Arduino.
+
+    frame : bytes
+        The frame to be sent.
     """
-    time_of_boot = datetime.datetime.fromtimestamp(psutil.boot_time())
-    time_since_boot = datetime.datetime.now() - time_of_boot
-    # timedelta internal values
-    days_since_boot = time_since_boot.days
-    # seconds excluding days
-    seconds_since_boot = time_since_boot.seconds
+    while frame:
+        frame = frame[os.write(serial_fd, frame):]
+    termios.tcdrain(serial_fd)
 
-    # calculate the other values as integers
-    minutes_since_boot = seconds_since_boot / 60
-    hours_since_boot = int(minutes_since_boot / 60)
-    minutes_since_boot = int(minutes_since_boot - (hours_since_boot * 60))
+def wait_until_ready(arduino: serial.Serial) -> bool:
+    """ Waits until the Arduino is ready to receive, at most 'serial_init_interval_seconds'.
 
-    # cast to padded strings
-    days_since_boot = str(days_since_boot).rjust(4, ' ')
-    hours_since_boot = str(hours_since_boot).rjust(2, ' ')
-    minutes_since_boot = str(minutes_since_boot).rjust(2, ' ')
+    Opening the serial port resets the Arduino. Until it acknowledges a readiness request ('?')
+    with 'K', the request is repeated. After the acknowledgement, one more handshake timeout is
+    waited, so that a repeated request can't merge with the first frame.
 
-    # calculate values to be inserted
+    Arguments
+    ---------
+    arduino : serial.Serial
+        The freshly opened serial connection to the Arduino.
 
-    output = (
-        '     Uptime     ',
-        '{0} d {1} h {2} m'.format(days_since_boot, hours_since_boot, minutes_since_boot)
-    )
+    Returns
+    -------
+    ready : bool
+        Whether the Arduino acknowledged the readiness request before the time ran out.
+    """
+    arduino.timeout = serial_handshake_timeout_seconds
+    deadline = time.monotonic() + serial_init_interval_seconds
+
+    while time.monotonic() < deadline:
+        arduino.write(b'?')
+        if arduino.read(1) == b'K':
+            # the 'K' may have answered an earlier request, let the Arduino process any
+            # request still in flight and discard its answer before sending the first frame
+            time.sleep(serial_handshake_timeout_seconds)
+            arduino.reset_input_buffer()
+            return True
 
-    return output
+    return False
 
 def main():
-    """ Periodically sends system information strings to the serial port.
+    """ Periodically sends system information frames to the serial port.
     """
 
     # open the serial port
     arduino = serial.Serial(port=file_descriptor, baudrate=baud_rate)
-    # wait a while until it is ready to receive
-    time.sleep(serial_init_interval_seconds)
+    # frames are written to the underlying file descriptor directly. pyserial opens it in
+    # non-blocking mode, which is cleared so that os.write() waits for space in the output
+    # buffer instead of raising BlockingIOError
+    serial_fd = arduino.fileno()
+    fcntl.fcntl(serial_fd, fcntl.F_SETFL, fcntl.fcntl(serial_fd, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+    # wait until it is ready to receive
+    if not wait_until_ready(arduino):
+        print("main(): No readiness acknowledgement from the Arduino, sending anyway.")
 
     # functions displaying different system information in the same format
     sysinfo_functions = [
@@ -269,13 +379,26 @@ def main():
         get_cpu_mobo_temperature
     ]
 
+    # transmissions are scheduled on a fixed grid of monotonic deadlines, so that the time
+    # spent collecting and sending information does not accumulate as drift
+    deadline = time.monotonic()
+
+    # frames are transmitted by a background thread, so that the main loop can already
+    # sleep while the serial port is still busy sending
+    sender = ThreadPoolExecutor(max_workers=1)
+    pending_send = None
+
     # begin continuous loop, wait between transmissions
     while True:
         # call each function and send its output to the serial connection
         for function in sysinfo_functions:
-            display_output = function()
-            arduino.write(bytes(display_output[0] + display_output[1], 'utf-8'))
-            time.sleep(serial_update_interval_seconds)
+            # re-raise any error from sending the previous frame
+            if pending_send is not None:
+                pending_send.result()
+            # send both rows as a single 32-byte frame, copied since the frame buffer is reused
+            pending_send = sender.submit(send_frame, serial_fd, bytes(function()))
+            deadline += serial_update_interval_seconds
+            time.sleep(max(0.0, deadline - time.monotonic()))
 
 if __name__ == "__main__":
     main()